@@ -375,9 +375,10 @@ class Exact(Inference):
                 if len(covfunc.hyp) > 0:
                     for ii in range(len(covfunc.hyp)):
                         dnlZ.cov[ii] = old_div((Q*covfunc.getDerMatrix(x=x, mode='train', der=ii)).sum(),2.)
-                if meanfunc.hyp:
+                if len(meanfunc.hyp) > 0:
+                    dms = meanfunc.getAllDerMatrices(x)        # all mean derivatives at once
                     for ii in range(len(meanfunc.hyp)):
-                        dnlZ.mean[ii] = np.dot(-meanfunc.getDerMatrix(x, ii).T,alpha)
+                        dnlZ.mean[ii] = np.dot(-dms[ii].T,alpha)
                         dnlZ.mean[ii] = dnlZ.mean[ii][0,0]
                 return post, nlZ[0,0], dnlZ
             return post, nlZ[0,0]
@@ -446,8 +447,9 @@ class FITC_Exact(Inference):
                 dnlZ.lik += old_div((np.dot(w.T,np.dot(dKuui,w)) -np.dot(al.T,(v*al)) \
                                  - np.dot(np.array([(W*W).sum(axis=0)]),v) - (np.dot(R,W.T)*np.dot(B,W.T)).sum() ),2.)
                 dnlZ.lik = list(dnlZ.lik[0])
+                dms = meanfunc.getAllDerMatrices(x)
                 for ii in range(len(meanfunc.hyp)):
-                    dnlZ.mean[ii] = np.dot(-meanfunc.getDerMatrix(x, ii).T, al)
+                    dnlZ.mean[ii] = np.dot(-dms[ii].T, al)
                     dnlZ.mean[ii] = dnlZ.mean[ii][0,0]
 
                 return post, nlZ[0,0], dnlZ
@@ -554,8 +556,9 @@ class Laplace(Inference):
                 b = np.dot(K,dlp_dhyp)                                       # b-K*(Z*b) = inv(eye(n)+K*diag(W))*b
                 dnlZ.lik[ii] -= np.dot(dfhat.T,b-np.dot(K,np.dot(Z,b)))      # implicit part
                 dnlZ.lik[ii] = dnlZ.lik[ii][0,0]
+            dms = meanfunc.getAllDerMatrices(x)
             for ii in range(len(meanfunc.hyp)):                              # mean hypers
-                dm = meanfunc.getDerMatrix(x, ii)
+                dm = dms[ii]
                 dnlZ.mean[ii] = -np.dot(alpha.T,dm)                          # explicit part
                 dnlZ.mean[ii] -= np.dot(dfhat.T,dm-np.dot(K,np.dot(Z,dm)))   # implicit part
                 dnlZ.mean[ii] = dnlZ.mean[ii][0,0]
@@ -707,8 +710,9 @@ class FITC_Laplace(Inference):
                     dnlZ.lik[ii] += z
                     dnlZ.lik[ii] = dnlZ.lik[ii][0,0]
 
+            dms = meanfunc.getAllDerMatrices(x)
             for ii in range(len(meanfunc.hyp)):                           # mean hypers
-                dm = meanfunc.getDerMatrix(x, ii)
+                dm = dms[ii]
                 dnlZ.mean[ii] = -np.dot(alpha.T,dm)                       # explicit part
                 Zdm = self._mvmZ(dm,RVdd,t)
                 dnlZ.mean[ii] -= np.dot(dfhat.T,(dm-self._mvmK(Zdm,V,d0))) # implicit part
@@ -797,8 +801,9 @@ class EP(Inference):
                 dlik = likfunc.evaluate(y, old_div(nu_n,tau_n), old_div(1,tau_n), inffunc, ii)
                 dnlZ.lik[ii] = -dlik.sum()
             junk,dlZ = likfunc.evaluate(y, old_div(nu_n,tau_n), old_div(1,tau_n), inffunc, None, 2) # mean hyps
+            dms = meanfunc.getAllDerMatrices(x)
             for ii in range(len(meanfunc.hyp)):
-                dm = meanfunc.getDerMatrix(x, ii)
+                dm = dms[ii]
                 dnlZ.mean[ii] = -np.dot(dlZ.T,dm)
                 dnlZ.mean[ii] = dnlZ.mean[ii][0,0]
             return post, nlZ[0], dnlZ
@@ -934,8 +939,9 @@ class FITC_EP(Inference):
                     dnlZ.lik[ii] += snu2*z
                     dnlZ.lik[ii] = dnlZ.lik[ii][0,0]
             [junk,dlZ] = likfunc.evaluate(y, old_div(nu_n,tau_n), old_div(1,tau_n), inffunc, None, 2) # mean hyps
+            dms = meanfunc.getAllDerMatrices(x)
             for ii in range(len(meanfunc.hyp)):
-                dm = meanfunc.getDerMatrix(x, ii)
+                dm = dms[ii]
                 dnlZ.mean[ii] = -np.dot(dlZ.T,dm)
                 dnlZ.mean[ii] = dnlZ.mean[ii][0,0]
 
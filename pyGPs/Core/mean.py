@@ -26,11 +26,16 @@ from builtins import object
 #
 # composite mean functions:
 #
+#   CompositeMean   - base class of the composite mean functions
 #   ScaleOfMean     - scaled version of a mean function
 #   PowerOfMean     - power of a mean function
 #   ProductOfMean   - products of mean functions
 #   SumOfMean       - sums of mean functions
 #
+# compiled mean functions:
+#
+#   MeanProgram     - flat evaluation plan of a mean function tree (see Mean.compile)
+#
 #
 # This is a object-oriented python implementation of gpml functionality
 # (Copyright (c) by Carl Edward Rasmussen and Hannes Nickisch, 2011-02-18).
@@ -42,12 +47,67 @@ from builtins import object
 
 import numpy as np
 import math
+import copy
 import logging
 
+
+
+def _dtype(x):
+    '''Output dtype for inputs x: float32 inputs stay in single precision, all others use float64.'''
+    if x.dtype == np.float32:
+        return np.float32
+    return np.float64
+
+
+
+# shared read-only constant vectors, built once per value, number of data points and dtype
+_CONST_BUFS = {}                 # (value, n, dtype) -> read-only (n,1) vector
+_CONST_BUFS_MAX = 32             # the cache is emptied when full, so it stays bounded
+
+def _shared(value, n, dtype):
+    key = (value, n, dtype)
+    A = _CONST_BUFS.get(key)
+    if A is None:
+        if len(_CONST_BUFS) >= _CONST_BUFS_MAX:
+            _CONST_BUFS.clear()
+        A = np.full((n,1), value, dtype=dtype)
+        A.flags.writeable = False    # shared between all means, callers must not modify it
+        _CONST_BUFS[key] = A
+    return A
+
+def _zeros(n, dtype=np.float64):
+    return _shared(0., n, dtype)
+
+def _ones(n, dtype=np.float64):
+    return _shared(1., n, dtype)
+
+
+
+# opcodes of a MeanProgram
+_OP_LEAF, _OP_ADD, _OP_MUL, _OP_SCALE, _OP_POWER = list(range(5))
+
+
+
 class Mean(object):
     '''
     The base function for mean function
+
+    hyp of a standalone simple mean is kept as given (usually a list). Once a
+    mean is part of a composite mean, hyp of every mean in the tree is a float
+    numpy array viewing one flat array of the root, and assigning hyp writes
+    into that view. Use len(m.hyp) and list(m.hyp) where a list is expected:
+    m.hyp + [...] adds elementwise on an array.
+
+    A mean that is already part of a composite mean is copied when it is
+    combined again, e.g. in l + c and l * c the second composite holds a copy
+    of l, so later changes of l.hyp only reach the first one. Combining a mean
+    with hyperparameters with itself (c * c) raises an exception.
     '''
+    _mean_cache = None           # (x, hyp, mean vector) of the last cached evaluation
+    _buf_cache = None            # slot -> (x, value, constant vector)
+    _hyp_bound = False           # True once part of a composite mean
+    _caches = ('_mean_cache', '_buf_cache')   # attributes dropped on copy and pickle
+
     def __init__(self):
         super(Mean, self).__init__()
         self.hyp = []
@@ -55,6 +115,24 @@ class Mean(object):
         self.logger = logging.getLogger(__name__)
 
 
+    def _setHyp(self, hyp):
+        if not self._hyp_bound:
+            self._hyp = hyp
+        else:                                    # keep the view into the array of the tree
+            self._hyp[:] = hyp
+    def _getHyp(self):
+        return self._hyp
+    hyp = property(_getHyp,_setHyp)
+
+
+    def __getstate__(self):
+        # cached results hold references to the inputs, copies start without them
+        state = self.__dict__.copy()
+        for name in self._caches:
+            state.pop(name, None)
+        return state
+
+
     def __repr__(self):
         strvalue =str(type(self))+': to get the mean vector or mean derviatives use: \n'+\
               'model.meanfunc.getMean()\n'+\
@@ -84,13 +162,14 @@ class Mean(object):
 
         :param other: mean function as product or int/float as scalar
         :return: an instance of ScaleOfMean or ProductOfMean
+        :raises TypeError: if other is neither a number nor a mean function
         '''
-        if isinstance(other, int) or isinstance(other, float):
+        if isinstance(other, (int, float, np.number)):
             return ScaleOfMean(self,other)
         elif isinstance(other, Mean):
             return ProductOfMean(self,other)
         else:
-            self.logger.error("only numbers and Means are allowed for *")
+            raise TypeError("only numbers and Means are allowed for *")
 
 
 
@@ -106,11 +185,12 @@ class Mean(object):
 
         :param int number: power of the mean function
         :return: an instance of PowerOfMean
+        :raises TypeError: if number is not a positive integer
         '''
-        if isinstance(number, int) and number > 0:
+        if isinstance(number, (int, np.integer)) and number > 0:
             return PowerOfMean(self,number)
         else:
-            self.logger.error("only non-zero integers are supported for **")
+            raise TypeError("only positive integers are supported for **")
 
 
 
@@ -118,16 +198,54 @@ class Mean(object):
         '''
         Get the mean vector based on the inputs.
 
+        The returned (n,1) array may be cached and shared between calls (and
+        between mean functions); it is then read-only. Copy it before
+        modifying it in place, e.g. A = m.getMean(x).copy(). Cached results
+        are found by the identity of x, so x must not be modified in place
+        between calls; pass a new array for new inputs.
+
         :param x: training data
         '''
         pass
 
 
 
+    def getMeanBatched(self, xs=None):
+        '''
+        Get the mean vectors for a batch of inputs in one call.
+
+        :param xs: batch of inputs, shape (B,n,D)
+
+        :return: mean vectors, shape (B,n,1); means with a constant value
+            return a read-only broadcast view that does not allocate
+        '''
+        xs = np.asarray(xs)
+        A = np.stack([self.getMean(x) for x in xs], axis=0)
+        return A
+
+
+
+    def getScaledMean(self, x=None, c=1.):
+        '''
+        Get the mean vector multiplied by a scalar. Subclasses may override
+        this to fold the scale into their own computation.
+
+        :param x: training data
+        :param c: scalar
+        '''
+        A = float(c) * self.getMean(x)
+        return A
+
+
+
     def getDerMatrix(self, x=None, der=None):
         '''
         Compute derivatives wrt. hyperparameters.
 
+        As for getMean, the returned (n,1) array may be shared: a cached
+        read-only vector, or for Linear a view of a column of x. Copy it before
+        modifying it in place, writing into a view of x changes the inputs.
+
         :param x: training inputs
         :param int der: index of hyperparameter whose derivative to be computed
 
@@ -137,141 +255,467 @@ class Mean(object):
 
 
 
-class ProductOfMean(Mean):
+    def getAllDerMatrices(self, x=None):
+        '''
+        Compute derivatives wrt. all hyperparameters in one call.
+
+        The same contract as for getDerMatrix applies: the result is not
+        guaranteed to be a new array, so copy it before modifying it in place.
+
+        :param x: training inputs
+
+        :return: derivative matrices stacked along the first axis, shape (len(hyp), n, 1)
+        '''
+        n, D = x.shape
+        if len(self.hyp) == 0:
+            return np.zeros((0,n,1), dtype=_dtype(x))
+        A = np.stack([self.getDerMatrix(x, der) for der in range(len(self.hyp))], axis=0)
+        return A
+
+
+
+    def compile(self, x_shape=None):
+        '''
+        Compile the mean function tree into a flat evaluation plan which is
+        executed by a single loop instead of recursive method calls.
+        The plan reads the current hyperparameters on every call, so it stays
+        valid while hyp is optimized. Compile again if the tree itself changes.
+
+        :param x_shape: shape (n,D) of the inputs, used to preallocate scratch buffers
+
+        :return: an instance of MeanProgram
+        '''
+        ops = []
+        self._emit(ops, 0)
+        return MeanProgram(self, ops, x_shape)
+
+
+
+    def _emit(self, ops, offset):
+        '''
+        Append the opcodes evaluating this mean to ops in postfix order.
+        Simple means are evaluated as a whole by their own methods.
+
+        :param list ops: opcodes emitted so far
+        :param int offset: position of the first hyperparameter of this mean in the root hyp
+        '''
+        ops.append((_OP_LEAF, self, offset, len(self.hyp)))
+
+
+
+    def _getCachedMean(self, x):
+        '''
+        Get the mean vector, reusing the last result if neither x nor hyp changed.
+        Used by composite means whose derivatives need the same mean vector of
+        a child for every hyperparameter index. Like the other caches of the
+        means, the entry holds a reference to x, so the id of x can not be
+        reused by a new array while it is cached.
+
+        :param x: training data
+        '''
+        hyp = tuple(self.hyp)
+        cache = self._mean_cache
+        if cache is not None and cache[0] is x and cache[1] == hyp:
+            return cache[2]
+        A = self.getMean(x)
+        self._mean_cache = (x, hyp, A)
+        return A
+
+
+
+    def _getHypOwners(self):
+        '''
+        Table with one entry (owner, local index, chain) per hyperparameter,
+        see CompositeMean. A simple mean owns all of its hyperparameters.
+        '''
+        return [(self, i, ()) for i in range(len(self.hyp))]
+
+
+
+    def _getOwnDerMatrix(self, x, der):
+        '''
+        Derivative wrt. the hyperparameter der owned by this mean itself.
+        For simple means these are all of their hyperparameters.
+        '''
+        return self.getDerMatrix(x, der)
+
+
+
+    def _bind_hyp_view(self, arr, offset):
+        '''
+        Store the hyperparameters in arr[offset:offset+len(hyp)] and make hyp a
+        view of that slice. Composite means call this once on construction, so
+        the whole tree shares one flat array and setting the hyperparameters of
+        the root is a single in-place write.
+
+        :param arr: flat float array holding the hyperparameters of the whole tree
+        :param int offset: position of the first hyperparameter of this mean in arr
+
+        :return: position behind the last hyperparameter of this mean
+        '''
+        end = offset + len(self._hyp)
+        arr[offset:end] = self._hyp
+        self._hyp = arr[offset:end]
+        return end
+
+
+
+    def _getConstVector(self, x, value, slot=None):
+        '''
+        Get a read-only (n,1) vector filled with value. The vector is reused
+        while x and value stay the same, so repeated calls during optimization
+        on fixed inputs do not allocate.
+
+        :param x: training data
+        :param value: constant to fill the vector with
+        :param slot: name of the cache entry, defaults to value
+        '''
+        if self._buf_cache is None:
+            self._buf_cache = {}
+        if slot is None:
+            slot = value
+        cache = self._buf_cache.get(slot)
+        if cache is not None and cache[0] is x and cache[1] == value:
+            return cache[2]
+        n, D = x.shape
+        A = np.full((n,1), value, dtype=_dtype(x))
+        A.flags.writeable = False
+        self._buf_cache[slot] = (x, value, A)
+        return A
+
+
+
+class CompositeMean(Mean):
+    '''
+    Base class of the composite mean functions. On construction every composite
+    tabulates for each of its hyperparameters the mean owning it, the index
+    within that owner, and the chain of composites between the owner and itself
+    whose factors enter the derivative. getDerMatrix is then a table lookup
+    followed by the chain multiplication instead of a recursive descent.
+
+    The hyperparameters of the composite itself come first in its flat array,
+    followed by those of its children. Since every mean holds a view into the
+    array of its tree, a mean with hyperparameters that is already part of
+    another composite mean is copied into the new one.
+    '''
+    def _initHyp(self, own, children):
+        '''
+        Collect the own hyperparameters and those of the children into one flat
+        array and bind the children to views of it.
+
+        :param list own: hyperparameters of the composite itself
+        :param tuple children: the combined mean functions
+
+        :return: the children as part of this composite, copies of the ones already bound to another tree
+        '''
+        given = children
+        children = list(children)
+        for i, mean in enumerate(given):
+            if len(mean.hyp) == 0:
+                continue
+            if any(mean is m for m in given[:i]):
+                raise Exception("Error: "+type(mean).__name__+" can not be combined with itself, use a new instance")
+            if mean._hyp_bound:
+                children[i] = copy.deepcopy(mean)
+        children = tuple(children)
+        self._children = children
+        self._n_own = len(own)
+        self._hyp = np.array(list(own) + [h for mean in children for h in mean.hyp], dtype=np.float64)
+        self._bind_hyp_view(self._hyp, 0)
+        for mean in children:
+            mean._hyp_bound = True
+        return children
+
+    def _setHyp(self,hyp):
+        assert len(hyp) == len(self._hyp)
+        self._hyp[:] = hyp                       # children hold views, no copies needed
+    hyp = property(Mean._getHyp,_setHyp)
+
+    def __setstate__(self, state):
+        # copy and pickle give every mean its own array, share the copied one again
+        self.__dict__.update(state)
+        self._bind_hyp_view(self._hyp, 0)
+
+    def _bind_hyp_view(self, arr, offset):
+        end = offset + len(self._hyp)
+        arr[offset:end] = self._hyp
+        self._hyp = arr[offset:end]
+        offset += self._n_own
+        for mean in self._children:
+            offset = mean._bind_hyp_view(arr, offset)
+        return end
+
+    def _getHypOwners(self):
+        return self._hyp_owners
+
+    def _chainOwners(self, mean, side):
+        '''Owner table of a child, extended by this composite unless its factor is always one (side None).'''
+        link = () if side is None else ((self, side),)
+        return [(node, li, chain + link) for node, li, chain in mean._getHypOwners()]
+
+    def _getChainFactor(self, x, side):
+        '''Factor of the derivative of the given child in the derivative of this mean, None for one.'''
+        return None
+
+    def getDerMatrix(self, x=None, der=None):
+        if der >= len(self.hyp):
+            raise Exception("Error: der out of range for "+type(self).__name__)
+        node, li, chain = self._hyp_owners[der]
+        A = node._getOwnDerMatrix(x, li)
+        owned = False                            # A may be shared until the first factor is applied
+        for parent, side in chain:
+            f = parent._getChainFactor(x, side)
+            if f is None:
+                continue
+            if owned:
+                np.multiply(A, f, out=A)
+            else:
+                A = f * A
+                owned = True
+        return A
+
+
+
+class ProductOfMean(CompositeMean):
     '''Product of two mean fucntions.'''
     def __init__(self,mean1,mean2):
+        mean1, mean2 = self._initHyp([], (mean1, mean2))
         self.mean1 = mean1
         self.mean2 = mean2
-        if mean1.hyp and mean2.hyp:
-            self._hyp = mean1.hyp + mean2.hyp
-        elif not mean1.hyp:
-            self._hyp = mean2.hyp
-        elif not mean2.hyp:
-            self._hyp = mean1.hyp
-    def _setHyp(self,hyp):
-        assert len(hyp) == len(self._hyp)
-        len1 = len(self.mean1.hyp)
-        self._hyp = hyp
-        self.mean1.hyp = self._hyp[:len1]
-        self.mean2.hyp = self._hyp[len1:]
-    def _getHyp(self):
-        return self._hyp
-    hyp = property(_getHyp,_setHyp)
+        # algebraic simplification: 0 * m = 0 and 1 * m = m
+        self._isZero = isinstance(mean1, Zero) or isinstance(mean2, Zero)
+        if isinstance(mean1, One):
+            self._simplified = mean2
+        elif isinstance(mean2, One):
+            self._simplified = mean1
+        else:
+            self._simplified = None
+        if self._isZero:
+            self._hyp_owners = self._chainOwners(mean1, 0) + self._chainOwners(mean2, 0)
+        elif self._simplified is not None:       # the One factor has no hyperparameters
+            self._hyp_owners = self._chainOwners(self._simplified, None)
+        else:
+            self._hyp_owners = self._chainOwners(mean1, 1) + self._chainOwners(mean2, 2)
+
+    def _emit(self, ops, offset):
+        if self._isZero:
+            Mean._emit(self, ops, offset)
+        elif self._simplified is not None:       # the One factor has no hyperparameters
+            self._simplified._emit(ops, offset)
+        else:
+            self.mean1._emit(ops, offset)
+            self.mean2._emit(ops, offset+len(self.mean1.hyp))
+            ops.append((_OP_MUL,))
 
     def getMean(self, x=None):
+        if self._isZero:
+            return _zeros(x.shape[0], _dtype(x))
+        if self._simplified is not None:
+            return self._simplified.getMean(x)
         A = self.mean1.getMean(x) * self.mean2.getMean(x)
         return A
 
-    def getDerMatrix(self, x=None, der=None):
-        if der < len(self.mean1.hyp):
-            A = self.mean1.getDerMatrix(x, der) * self.mean2.getMean(x)
-        elif der < len(self.hyp):
-            der2 = der - len(self.mean1.hyp)
-            A = self.mean2.getDerMatrix(x, der2) * self.mean1.getMean(x)
+    def getMeanBatched(self, xs=None):
+        xs = np.asarray(xs)
+        if self._isZero:
+            return np.broadcast_to(_dtype(xs)(0.), xs.shape[:2]+(1,))
+        if self._simplified is not None:
+            return self._simplified.getMeanBatched(xs)
+        A = self.mean1.getMeanBatched(xs) * self.mean2.getMeanBatched(xs)
+        return A
+
+    def _getChainFactor(self, x, side):
+        if side == 0:                            # 0 * m
+            return 0.
+        elif side == 1:
+            return self.mean2._getCachedMean(x)
         else:
-            raise Exception("Error: der out of range for meanProduct")
+            return self.mean1._getCachedMean(x)
+
+    def getAllDerMatrices(self, x=None):
+        if self._isZero:                         # 0 * dA, as in getDerMatrix
+            A = 0. * np.concatenate((self.mean1.getAllDerMatrices(x),
+                                     self.mean2.getAllDerMatrices(x)), axis=0)
+            return A
+        if self._simplified is not None:
+            return self._simplified.getAllDerMatrices(x)
+        a1 = self.mean1._getCachedMean(x)
+        a2 = self.mean2._getCachedMean(x)
+        len1 = len(self.mean1.hyp)
+        A = np.empty((len(self.hyp),)+a1.shape, dtype=_dtype(x))
+        np.multiply(self.mean1.getAllDerMatrices(x), a2, out=A[:len1])
+        np.multiply(self.mean2.getAllDerMatrices(x), a1, out=A[len1:])
         return A
 
 
 
-class SumOfMean(Mean):
+class SumOfMean(CompositeMean):
     '''Sum of two mean functions.'''
     def __init__(self,mean1,mean2):
+        mean1, mean2 = self._initHyp([], (mean1, mean2))
         self.mean1 = mean1
         self.mean2 = mean2
-        if mean1.hyp and mean2.hyp:
-            self._hyp = mean1.hyp + mean2.hyp
-        elif not mean1.hyp:
-            self._hyp = mean2.hyp
-        elif not mean2.hyp:
-            self._hyp = mean1.hyp
-    def _setHyp(self,hyp):
-        assert len(hyp) == len(self._hyp)
-        len1 = len(self.mean1.hyp)
-        self._hyp = hyp
-        self.mean1.hyp = self._hyp[:len1]
-        self.mean2.hyp = self._hyp[len1:]
-    def _getHyp(self):
-        return self._hyp
-    hyp = property(_getHyp,_setHyp)
+        # algebraic simplification: 0 + m = m
+        if isinstance(mean1, Zero):
+            self._simplified = mean2
+        elif isinstance(mean2, Zero):
+            self._simplified = mean1
+        else:
+            self._simplified = None
+        self._hyp_owners = self._chainOwners(mean1, None) + self._chainOwners(mean2, None)
+
+    def _emit(self, ops, offset):
+        if self._simplified is not None:         # the Zero summand has no hyperparameters
+            self._simplified._emit(ops, offset)
+        else:
+            self.mean1._emit(ops, offset)
+            self.mean2._emit(ops, offset+len(self.mean1.hyp))
+            ops.append((_OP_ADD,))
 
     def getMean(self, x=None):
+        if self._simplified is not None:
+            return self._simplified.getMean(x)
         A = self.mean1.getMean(x) + self.mean2.getMean(x)
         return A
 
-    def getDerMatrix(self, x=None, der=None):
-        if der < len(self.mean1.hyp):
-            A = self.mean1.getDerMatrix(x, der)
-        elif der < len(self.hyp):
-            der2 = der - len(self.mean1.hyp)
-            A = self.mean2.getDerMatrix(x, der2)
-        else:
-            raise Exception("Error: der out of range for meanSum")
+    def getMeanBatched(self, xs=None):
+        xs = np.asarray(xs)
+        if self._simplified is not None:
+            return self._simplified.getMeanBatched(xs)
+        A = self.mean1.getMeanBatched(xs) + self.mean2.getMeanBatched(xs)
+        return A
+
+    def getAllDerMatrices(self, x=None):
+        if self._simplified is not None:         # the Zero summand has no hyperparameters
+            return self._simplified.getAllDerMatrices(x)
+        A = np.concatenate((self.mean1.getAllDerMatrices(x),
+                            self.mean2.getAllDerMatrices(x)), axis=0)
         return A
 
 
 
-class ScaleOfMean(Mean):
+class ScaleOfMean(CompositeMean):
     '''Scale of a mean function.'''
     def __init__(self,mean,scalar):
+        mean, = self._initHyp([scalar], (mean,))
         self.mean = mean
-        if mean.hyp:
-            self._hyp = [scalar] + mean.hyp
-        else:
-            self._hyp = [scalar]
-    def _setHyp(self,hyp):
-        assert len(hyp) == len(self._hyp)
-        self._hyp = hyp
-        self.mean.hyp = self._hyp[1:]
-    def _getHyp(self):
-        return self._hyp
-    hyp = property(_getHyp,_setHyp)
+        self._hyp_owners = [(self, 0, ())] + self._chainOwners(mean, 1)
+
+    def _emit(self, ops, offset):
+        self.mean._emit(ops, offset+1)
+        ops.append((_OP_SCALE, self, offset))
 
     def getMean(self, x=None):
-        c = self.hyp[0]                          # scale parameter
-        A = c * self.mean.getMean(x)             # accumulate means
+        c = float(self.hyp[0])                   # scale parameter
+        if c == 0:                               # 0 * m = 0
+            A = _zeros(x.shape[0], _dtype(x))
+        elif c == 1:                             # 1 * m = m
+            A = self.mean.getMean(x)
+        else:
+            A = self.mean.getScaledMean(x, c)    # accumulate means
         return A
 
-    def getDerMatrix(self, x=None, der=None):
-        c = self.hyp[0]                          # scale parameter
-        if der == 0:                             # compute derivative w.r.t. c
-            A = self.mean.getMean(x)
+    def getMeanBatched(self, xs=None):
+        xs = np.asarray(xs)
+        c = float(self.hyp[0])                   # scale parameter
+        if c == 0:                               # 0 * m = 0
+            A = np.broadcast_to(_dtype(xs)(0.), xs.shape[:2]+(1,))
+        elif c == 1:                             # 1 * m = m
+            A = self.mean.getMeanBatched(xs)
         else:
-            A = c * self.mean.getDerMatrix(x,der-1)
+            A = c * self.mean.getMeanBatched(xs)
+        return A
+
+    def getScaledMean(self, x=None, c=1.):
+        A = self.mean.getScaledMean(x, c * float(self.hyp[0]))   # merge nested scales
+        return A
+
+    def _getOwnDerMatrix(self, x, der):
+        A = self.mean.getMean(x)                 # derivative w.r.t. c
         return A
 
+    def _getChainFactor(self, x, side):
+        c = float(self.hyp[0])                   # scale parameter
+        if c == 1:
+            return None
+        return c
+
+    def getAllDerMatrices(self, x=None):
+        c = float(self.hyp[0])                   # scale parameter
+        a = self.mean._getCachedMean(x)
+        A = np.empty((len(self.hyp),)+a.shape, dtype=a.dtype)
+        A[0] = a                                 # derivative w.r.t. c
+        np.multiply(self.mean.getAllDerMatrices(x), c, out=A[1:])
+        return A
 
 
-class PowerOfMean(Mean):
+
+class PowerOfMean(CompositeMean):
     '''Power of a mean fucntion.'''
+    _factor_cache = None         # (x, hyp, d * a**(d-1))
+    _degree_cache = (None, 1)    # (hyp[0], d)
+    _caches = CompositeMean._caches + ('_factor_cache',)
+
     def __init__(self, mean, d):
+        mean, = self._initHyp([d], (mean,))
         self.mean = mean
-        if mean.hyp:
-            self._hyp = [d] + mean.hyp
-        else:
-            self._hyp = [d]
-    def _setHyp(self,hyp):
-        assert len(hyp) == len(self._hyp)
-        self._hyp = hyp
-        self.mean.hyp = self._hyp[1:]
-    def _getHyp(self):
-        return self._hyp
-    hyp = property(_getHyp,_setHyp)
+        self._hyp_owners = [(self, 0, ())] + self._chainOwners(mean, 1)
+
+    def _getDegree(self):
+        '''d = max(|floor(hyp[0])|,1), recomputed only when hyp[0] changes.'''
+        h = self.hyp[0]
+        if h != self._degree_cache[0]:
+            if math.isfinite(h):
+                d = max(abs(math.floor(h)),1)
+            else:                                # nan or inf propagate as in numpy
+                d = max(np.abs(np.floor(h)),1)
+            self._degree_cache = (h, d)
+        return self._degree_cache[1]
+
+    def _getPowerFactor(self, x, a, d):
+        '''d * a**(d-1), shared by the derivatives wrt. all hyperparameters of the base mean.'''
+        hyp = tuple(self.hyp)
+        cache = self._factor_cache
+        if cache is not None and cache[0] is x and cache[1] == hyp:
+            return cache[2]
+        F = np.power(a, d-1)
+        F *= d
+        self._factor_cache = (x, hyp, F)
+        return F
+
+    def _emit(self, ops, offset):
+        self.mean._emit(ops, offset+1)
+        ops.append((_OP_POWER, self, offset))
 
     def getMean(self, x=None):
-        d = np.abs(np.floor(self.hyp[0]))
-        d = max(d,1)
-        A = self.mean.getMean(x) **d              # accumulate means
+        d = self._getDegree()
+        A = np.power(self.mean.getMean(x), d)    # integer exponent
         return A
 
-    def getDerMatrix(self, x=None, der=None):
-        d = np.abs(np.floor(self.hyp[0]))
-        d = max(d,1)
-        if der == 0:                             # compute derivative w.r.t. c
-            a = self.mean.getMean(x)
-            A = a**d * np.log(a)
-        else:
-            A = d * self.mean.getMean(x) ** (d-1) * self.mean.getDerMatrix(x, der-1)
+    def getMeanBatched(self, xs=None):
+        xs = np.asarray(xs)
+        d = self._getDegree()
+        A = np.power(self.mean.getMeanBatched(xs), d)
+        return A
+
+    def _getOwnDerMatrix(self, x, der):
+        d = self._getDegree()
+        a = self.mean._getCachedMean(x)
+        A = np.log(a)                            # derivative w.r.t. d
+        A *= np.power(a, d)
+        return A
+
+    def _getChainFactor(self, x, side):
+        d = self._getDegree()
+        return self._getPowerFactor(x, self.mean._getCachedMean(x), d)
+
+    def getAllDerMatrices(self, x=None):
+        d = self._getDegree()
+        a = self.mean._getCachedMean(x)
+        A = np.empty((len(self.hyp),)+a.shape, dtype=a.dtype)
+        np.log(a, out=A[0])                      # derivative w.r.t. d
+        A[0] *= np.power(a, d)
+        np.multiply(self._getPowerFactor(x, a, d), self.mean.getAllDerMatrices(x), out=A[1:])
         return A
 
 
@@ -283,13 +727,20 @@ class Zero(Mean):
         self.name = '0'
 
     def getMean(self, x=None):
-        n, D = x.shape
-        A = np.zeros((n,1))
+        A = _zeros(x.shape[0], _dtype(x))
+        return A
+
+    def getMeanBatched(self, xs=None):
+        xs = np.asarray(xs)
+        A = np.broadcast_to(_dtype(xs)(0.), xs.shape[:2]+(1,))
+        return A
+
+    def getScaledMean(self, x=None, c=1.):
+        A = _zeros(x.shape[0], _dtype(x))
         return A
 
     def getDerMatrix(self, x=None, der=None):
-        n, D = x.shape
-        A = np.zeros((n,1))
+        A = _zeros(x.shape[0], _dtype(x))
         return A
 
 
@@ -301,13 +752,20 @@ class One(Mean):
         self.name = '1'
 
     def getMean(self, x=None):
-        n, D = x.shape
-        A = np.ones((n,1))
+        A = _ones(x.shape[0], _dtype(x))
+        return A
+
+    def getMeanBatched(self, xs=None):
+        xs = np.asarray(xs)
+        A = np.broadcast_to(_dtype(xs)(1.), xs.shape[:2]+(1,))
+        return A
+
+    def getScaledMean(self, x=None, c=1.):
+        A = self._getConstVector(x, c, 'scaled')
         return A
 
     def getDerMatrix(self, x=None, der=None):
-        n, D = x.shape
-        A = np.zeros((n,1))
+        A = _zeros(x.shape[0], _dtype(x))
         return A
 
 
@@ -322,16 +780,23 @@ class Const(Mean):
         self.hyp = [c]
 
     def getMean(self, x=None):
-        n,D = x.shape
-        A = self.hyp[0] * np.ones((n,1))
+        A = self._getConstVector(x, self.hyp[0], 'mean')
+        return A
+
+    def getMeanBatched(self, xs=None):
+        xs = np.asarray(xs)
+        A = np.broadcast_to(_dtype(xs)(self.hyp[0]), xs.shape[:2]+(1,))
+        return A
+
+    def getScaledMean(self, x=None, c=1.):
+        A = self._getConstVector(x, c * self.hyp[0], 'scaled')
         return A
 
     def getDerMatrix(self, x=None, der=None):
-        n,D = x.shape
         if der == 0:                  # compute derivative vector wrt c
-            A = np.ones((n,1))
+            A = _ones(x.shape[0], _dtype(x))
         else:
-            A = np.zeros((n,1))
+            A = _zeros(x.shape[0], _dtype(x))
         return A
 
 
@@ -343,6 +808,10 @@ class Linear(Mean):
     :param D: dimension of training data. Set if you want default alpha, which is 0.5 for each dimension.
     :alpha_list: scalar alpha for each dimension
     '''
+    _mean_lru = None             # [(x, hyp, mean vector)], most recently used last
+    _coef_cache = None           # (hyp, coefficient column vector)
+    _caches = Mean._caches + ('_mean_lru',)
+
     def __init__(self, D=None, alpha_list=None):
         if alpha_list is None:
             if D is None:
@@ -351,27 +820,197 @@ class Linear(Mean):
                 self.hyp = [0.5 for i in range(D)]
         else:
             self.hyp = alpha_list
+    def _getCoef(self):
+        '''Coefficient column vector, rebuilt only when the values in hyp changed.'''
+        hyp = tuple(self.hyp)
+        if self._coef_cache is None or self._coef_cache[0] != hyp:
+            self._coef_cache = (hyp, np.reshape(np.array(hyp, dtype=np.float64), (len(hyp),1)))
+        return self._coef_cache
+
+    def _linearMean(self, x, c):
+        A = np.ascontiguousarray(x).dot(c.astype(_dtype(x), copy=False))
+        return A
 
     def getMean(self, x=None):
-        n, D = x.shape
-        c = np.array(self.hyp)
-        c = np.reshape(c,(len(c),1))
-        A = np.dot(x,c)
+        # LRU cache of the last two results, line searches often revisit the same hyp
+        key, c = self._getCoef()
+        if self._mean_lru is None:
+            self._mean_lru = []
+        for i, (cx, ckey, A) in enumerate(self._mean_lru):
+            if cx is x and ckey == key:
+                self._mean_lru.append(self._mean_lru.pop(i))
+                return A
+        A = self._linearMean(x, c)
+        A.flags.writeable = False
+        self._mean_lru.append((x, key, A))
+        if len(self._mean_lru) > 2:
+            del self._mean_lru[0]
+        return A
+
+    def getScaledMean(self, x=None, c=1.):
+        A = self._linearMean(x, c * self._getCoef()[1])   # fold the scale into the coefficients
+        return A
+
+    def getMeanBatched(self, xs=None):
+        xs = np.asarray(xs)
+        A = np.matmul(xs, self._getCoef()[1].astype(_dtype(xs), copy=False))   # one batched product
         return A
 
     def getDerMatrix(self, x=None, der=None):
         n, D = x.shape
-        c = np.array(self.hyp)
-        c = np.reshape(c,(len(c),1))
         if isinstance(der, int) and der < D:     # compute derivative vector wrt meanparameters
-            A = np.reshape(x[:,der], (len(x[:,der]),1) )
+            A = x[:,der,None]
         else:
-            A = np.zeros((n,1))
+            A = _zeros(n, _dtype(x))
         return A
 
 
 
 
+class MeanProgram(object):
+    '''
+    Flat evaluation plan of a mean function tree, created by Mean.compile().
+    The opcodes are executed on a value stack; intermediate results are
+    written into scratch buffers that are reused between calls.
+
+    :param mean: the compiled mean function
+    :param list ops: opcodes in postfix order
+    :param x_shape: shape (n,D) of the inputs to preallocate scratch buffers for
+    '''
+    def __init__(self, mean, ops, x_shape=None):
+        self.mean = mean
+        self.ops = ops
+        # find the parent of each opcode to know which values a derivative needs
+        parent = [None for op in ops]
+        stack = []
+        for i, op in enumerate(ops):
+            if op[0] in (_OP_ADD, _OP_MUL):
+                parent[stack.pop()] = i
+                parent[stack.pop()] = i
+            elif op[0] in (_OP_SCALE, _OP_POWER):
+                parent[stack.pop()] = i
+            stack.append(i)
+        self._needs_value = [False for op in ops]
+        for i in reversed(range(len(ops))):
+            p = parent[i]
+            if p is not None:
+                self._needs_value[i] = ops[p][0] != _OP_ADD or self._needs_value[p]
+        self._bufs = None
+        self._bufs_key = None
+        if x_shape is not None:
+            self._getBuffers(x_shape[0], np.float64)
+
+    def __repr__(self):
+        strvalue = str(type(self))+': compiled plan of '+str(len(self.ops))+' opcodes for \n'+\
+                   str(type(self.mean))
+        return strvalue
+
+    def _getBuffers(self, n, dtype):
+        if self._bufs_key != (n, dtype):
+            last = len(self.ops) - 1             # the final result is returned, never buffered
+            self._bufs = [np.empty((n,1), dtype=dtype) if op[0] != _OP_LEAF and i < last else None
+                          for i, op in enumerate(self.ops)]
+            self._bufs_key = (n, dtype)
+        return self._bufs
+
+    def getMean(self, x=None):
+        '''
+        Get the mean vector based on the inputs.
+
+        :param x: training data
+        '''
+        n, D = x.shape
+        bufs = self._getBuffers(n, _dtype(x))
+        stack = []
+        for i, op in enumerate(self.ops):
+            code = op[0]
+            if code == _OP_LEAF:
+                stack.append(op[1].getMean(x))
+            elif code == _OP_ADD:
+                b = stack.pop()
+                stack[-1] = np.add(stack[-1], b, out=bufs[i])
+            elif code == _OP_MUL:
+                b = stack.pop()
+                stack[-1] = np.multiply(stack[-1], b, out=bufs[i])
+            elif code == _OP_SCALE:
+                stack[-1] = np.multiply(float(op[1].hyp[0]), stack[-1], out=bufs[i])
+            elif code == _OP_POWER:
+                stack[-1] = np.power(stack[-1], op[1]._getDegree(), out=bufs[i])
+        return stack[0]
+
+    def getDerMatrix(self, x=None, der=None):
+        '''
+        Compute derivatives wrt. hyperparameters (forward mode over the plan).
+
+        :param x: training inputs
+        :param int der: index of hyperparameter whose derivative to be computed
+
+        :return: the corresponding derivative matrix
+        '''
+        if der >= len(self.mean.hyp):
+            raise Exception("Error: der out of range for MeanProgram")
+        n, D = x.shape
+        bufs = self._getBuffers(n, _dtype(x))
+        values = []                              # None if not needed by any derivative
+        derivs = []                              # None if zero
+        for i, op in enumerate(self.ops):
+            code = op[0]
+            needs = self._needs_value[i]
+            if code == _OP_LEAF:
+                node, offset, nhyp = op[1:]
+                values.append(node.getMean(x) if needs else None)
+                if offset <= der < offset+nhyp:
+                    derivs.append(node.getDerMatrix(x, der-offset))
+                else:
+                    derivs.append(None)
+            elif code == _OP_ADD:
+                b, db = values.pop(), derivs.pop()
+                if derivs[-1] is None:
+                    derivs[-1] = db
+                elif db is not None:
+                    derivs[-1] = derivs[-1] + db
+                if needs:
+                    values[-1] = np.add(values[-1], b, out=bufs[i])
+            elif code == _OP_MUL:
+                b, db = values.pop(), derivs.pop()
+                a, da = values[-1], derivs[-1]
+                if da is None:
+                    derivs[-1] = None if db is None else a * db
+                elif db is None:
+                    derivs[-1] = da * b
+                else:
+                    derivs[-1] = da * b + a * db
+                if needs:
+                    values[-1] = np.multiply(a, b, out=bufs[i])
+            elif code == _OP_SCALE:
+                node, offset = op[1:]
+                c = float(node.hyp[0])
+                a = values[-1]
+                if der == offset:                # derivative w.r.t. c
+                    derivs[-1] = np.copy(a)      # a may live in a scratch buffer
+                elif derivs[-1] is not None:
+                    derivs[-1] = c * derivs[-1]
+                if needs:
+                    values[-1] = np.multiply(c, a, out=bufs[i])
+            elif code == _OP_POWER:
+                node, offset = op[1:]
+                d = node._getDegree()
+                a = values[-1]
+                if der == offset:                # derivative w.r.t. d
+                    A = np.log(a)
+                    A *= np.power(a, d)
+                    derivs[-1] = A
+                elif derivs[-1] is not None:
+                    derivs[-1] = d * np.power(a, d-1) * derivs[-1]
+                if needs:
+                    values[-1] = np.power(a, d, out=bufs[i])
+        A = derivs[0]
+        if A is None:
+            A = _zeros(n, _dtype(x))
+        return A
+
+
+
 if __name__ == '__main__':
     pass
 
@@ -76,7 +76,7 @@ class Optimizer(object):
 
     def _convert_to_array(self):
         '''Convert all hyparameters in the model to an array'''
-        hyplist = self.model.meanfunc.hyp + self.model.covfunc.hyp + self.model.likfunc.hyp
+        hyplist = list(self.model.meanfunc.hyp) + list(self.model.covfunc.hyp) + list(self.model.likfunc.hyp)
         return np.array(hyplist)
 
     def _apply_in_objects(self, hypInArray):
@@ -14,6 +14,8 @@ from builtins import range
 #================================================================================
 
 import unittest
+import copy
+import pickle
 import numpy as np
 import pyGPs
 
@@ -42,6 +44,10 @@ class MeanTests(unittest.TestCase):
         for der in range(len(m.hyp)):         # get derivatives
             derivative = m.getDerMatrix(x=self.x, der=der)
             self.checkDerOutput(derivative)
+        derivatives = m.getAllDerMatrices(x=self.x)   # get all derivatives at once
+        self.assertTrue(derivatives.shape == (len(m.hyp),)+mean.shape)
+        for der in range(len(m.hyp)):
+            self.assertTrue(np.allclose(derivatives[der], m.getDerMatrix(x=self.x, der=der)))
 
 
     def test_meanZero(self):
@@ -55,6 +61,30 @@ class MeanTests(unittest.TestCase):
         print("testing meanLinear...")
         m = pyGPs.mean.Linear(D=self.x.shape[1]) 
         self.checkMean(m)
+        m.getMean(self.x)
+        m.hyp[0] = 10.                       # in-place update of a single coefficient
+        self.assertTrue(np.allclose(m.getMean(self.x), self.x.dot(np.reshape(m.hyp, (-1,1)))))
+
+
+    def test_meanLinearCache(self):
+        print("testing cached results of meanLinear...")
+        m = pyGPs.mean.Linear(D=self.x.shape[1])
+        x2 = self.x + 1.
+        x3 = self.x + 2.
+        A = m.getMean(self.x)
+        self.assertFalse(A.flags.writeable)
+        self.assertTrue(m.getMean(self.x) is A)          # hit
+        m.getMean(x2)
+        self.assertTrue(m.getMean(self.x) is A)          # hit, still one of the last two
+        m.getMean(x2)
+        m.getMean(x3)
+        B = m.getMean(self.x)                            # evicted, recomputed
+        self.assertFalse(B is A)
+        self.assertTrue(np.allclose(B, A))
+        m.hyp = [1., 2., 3.]                             # new hyp invalidates
+        self.assertTrue(np.allclose(m.getMean(self.x), self.x.dot([[1.],[2.],[3.]])))
+        m.hyp[1] = 0.                                    # as does an in-place update
+        self.assertTrue(np.allclose(m.getMean(self.x), self.x.dot([[1.],[0.],[3.]])))
 
 
     def test_meanOne(self):
@@ -67,6 +97,12 @@ class MeanTests(unittest.TestCase):
         print("testing meanConst...")
         m = pyGPs.mean.Const() 
         self.checkMean(m)
+        A = m.getMean(self.x)
+        self.assertRaises(ValueError, A.__imul__, 2.)     # shared result is read-only
+        B = m.getMean(self.x).copy()
+        B *= 2.
+        self.assertTrue(np.allclose(m.getMean(self.x), m.hyp[0]))
+        self.assertTrue(np.allclose(pyGPs.mean.Zero().getMean(self.x), 0.))
 
 
     def test_meanScale(self):
@@ -85,12 +121,87 @@ class MeanTests(unittest.TestCase):
         print("testing (compositing mean) product of two means...")
         m = pyGPs.mean.One() * pyGPs.mean.Const() 
         self.checkMean(m)
+        m = pyGPs.mean.Zero() * pyGPs.mean.Linear(D=self.x.shape[1])
+        self.checkMean(m)
 
 
     def test_meanPower(self):
         print("testing (compositing mean) power of a mean...")
         m = pyGPs.mean.Const() ** 2
         self.checkMean(m)
+        m.hyp = [np.nan, 2.]                 # a non-finite degree propagates instead of raising
+        self.assertTrue(np.all(np.isnan(m.getMean(self.x))))
+
+    def test_meanCompile(self):
+        print("testing (compositing mean) compiled evaluation plan...")
+        m = (pyGPs.mean.Linear(D=self.x.shape[1]) + pyGPs.mean.Const()) ** 2 * 3. \
+            + pyGPs.mean.One() * pyGPs.mean.Const()
+        p = m.compile(self.x.shape)
+        self.assertTrue(np.allclose(p.getMean(x=self.x), m.getMean(x=self.x)))
+        for der in range(len(m.hyp)):
+            self.assertTrue(np.allclose(p.getDerMatrix(x=self.x, der=der), m.getDerMatrix(x=self.x, der=der)))
+
+    def test_meanFloat32(self):
+        print("testing single precision inputs...")
+        x = self.x.astype(np.float32)
+        m = (pyGPs.mean.Linear(D=x.shape[1]) + pyGPs.mean.Const()) * 2. + pyGPs.mean.One() ** 2
+        self.assertTrue(m.getMean(x=x).dtype == np.float32)
+        for der in range(len(m.hyp)):
+            self.assertTrue(m.getDerMatrix(x=x, der=der).dtype == np.float32)
+
+    def test_meanBatched(self):
+        print("testing (compositing mean) batched evaluation...")
+        xs = np.random.normal(loc=0.0, scale=1.0, size=(4,)+self.x.shape)
+        m = (pyGPs.mean.Linear(D=self.x.shape[1]) + pyGPs.mean.Const()) ** 2 * 3. \
+            + pyGPs.mean.One() * pyGPs.mean.Zero()
+        A = m.getMeanBatched(xs=xs)
+        self.assertTrue(A.shape == (4,)+self.x.shape[:1]+(1,))
+        for b in range(len(xs)):
+            self.assertTrue(np.allclose(A[b], m.getMean(x=xs[b])))
+        self.assertTrue(np.allclose(m.getMeanBatched(xs=xs.tolist()), A))     # nested lists
+        for m in [pyGPs.mean.Zero(), pyGPs.mean.Const(), pyGPs.mean.Const() * 2.]:
+            self.assertTrue(m.getMeanBatched(xs=xs.tolist()).shape == A.shape)
+
+    def test_meanHypViews(self):
+        print("testing hyperparameters of nested compositing means...")
+        l = pyGPs.mean.Linear(D=self.x.shape[1])
+        c = pyGPs.mean.Const()
+        inner = l * c
+        m = inner * 3. + pyGPs.mean.Const()
+        m.hyp = [2., 1., 2., 3., 4., 5.]                 # set on the root
+        self.assertTrue(np.allclose(l.hyp, [1., 2., 3.]) and np.allclose(c.hyp, [4.]))
+        self.assertTrue(np.allclose(m.getMean(self.x), 2.*self.x.dot([[1.],[2.],[3.]])*4. + 5.))
+        inner.hyp = [0., 1., 0., 2.]                     # set on a nested compositing mean
+        self.assertTrue(np.allclose(l.hyp, [0., 1., 0.]) and np.allclose(c.hyp, [2.]))
+        self.assertTrue(np.allclose(m.hyp, [2., 0., 1., 0., 2., 5.]))
+        self.assertTrue(np.allclose(m.getMean(self.x), 2.*self.x[:,1:2]*2. + 5.))
+        l.hyp = [1., 1., 1.]                             # set on a leaf
+        self.assertTrue(np.allclose(m.hyp, [2., 1., 1., 1., 2., 5.]))
+        n = l + pyGPs.mean.Const()                       # l is already part of m, n holds a copy
+        n.hyp = [0., 0., 0., 1.]
+        self.assertTrue(np.allclose(l.hyp, [1., 1., 1.]) and np.allclose(n.mean1.hyp, [0., 0., 0.]))
+        self.assertRaises(Exception, lambda: c * c)
+
+
+    def test_meanCopy(self):
+        print("testing copies of compositing means...")
+        m = (pyGPs.mean.Linear(D=self.x.shape[1]) * pyGPs.mean.Const()) * 2. + pyGPs.mean.Const()
+        m.getMean(self.x)
+        for c in [copy.deepcopy(m), pickle.loads(pickle.dumps(m))]:
+            c.hyp = [3., 1., 2., 3., 4., 5.]             # the children of the copy follow its root
+            self.assertTrue(np.allclose(c.mean1.mean.mean1.hyp, [1., 2., 3.]))
+            self.assertTrue(np.allclose(c.getMean(self.x), 3.*self.x.dot([[1.],[2.],[3.]])*4. + 5.))
+            c.mean1.mean.mean2.hyp = [0.]
+            self.assertTrue(np.allclose(c.hyp, [3., 1., 2., 3., 0., 5.]))
+            self.assertTrue(np.allclose(m.hyp, [2., .5, .5, .5, 5., 5.]))   # the original is unchanged
+
+
+    def test_meanInvalidOperands(self):
+        print("testing (compositing mean) invalid operands...")
+        m = pyGPs.mean.Const()
+        self.assertRaises(TypeError, lambda: m * 'a')
+        self.assertRaises(TypeError, lambda: m ** 0)
+        self.assertRaises(TypeError, lambda: m ** 1.5)
 
     # Test your customized mean function
     '''